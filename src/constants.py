@@ -26,6 +26,7 @@ model_type = 'unigram'
 device = torch.device('cuda') if torch.cuda.is_available() else torch.device('cpu')
 learning_rate = 1e-4
 batch_size = 80
+accum_steps = 4  # micro-batches per optimizer step (effective batch = batch_size * accum_steps)
 seq_len = 200
 num_heads = 8
 num_layers = 6
@@ -1,8 +1,10 @@
 from tqdm import tqdm
 from torch.utils.data import Dataset, DataLoader
+from torch.utils.data.distributed import DistributedSampler
 from constants import *
 
 import torch
+import torch.distributed as dist
 import sentencepiece as spm
 import numpy as np
 
@@ -30,7 +32,19 @@ def get_data_loader(file_name):
     print(f"The shape of output trg data: {np.shape(output_trg_list)}")
 
     dataset = CustomDataset(src_list, input_trg_list, output_trg_list)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    # Pinned host memory lets the H2D copies overlap with compute (see non_blocking=True in Manager)
+    loader_kwargs = {
+        'batch_size': batch_size,
+        'pin_memory': torch.cuda.is_available(),
+        'num_workers': 4,
+        'persistent_workers': True,
+    }
+    if dist.is_available() and dist.is_initialized():
+        # Each DDP rank reads a disjoint shard of the dataset
+        sampler = DistributedSampler(dataset)
+        dataloader = DataLoader(dataset, sampler=sampler, **loader_kwargs)
+    else:
+        dataloader = DataLoader(dataset, shuffle=True, **loader_kwargs)
 
     return dataloader
 
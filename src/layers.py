@@ -42,15 +42,25 @@ class DecoderLayer(nn.Module):
         self.feed_forward = FeedFowardLayer()
         self.drop_out_3 = nn.Dropout(drop_out_rate)
 
-    def forward(self, x, e_output, e_mask,  d_mask):
+    def forward(self, x, e_output, e_mask,  d_mask, cache=None):
         x_1 = self.layer_norm_1(x) # (B, L, d_model)
-        x = x + self.drop_out_1(
-            self.masked_multihead_attention(x_1, x_1, x_1, mask=d_mask)
-        ) # (B, L, d_model)
+        if cache is None:
+            masked_attention = self.masked_multihead_attention(x_1, x_1, x_1, mask=d_mask)
+        else:
+            # Reuse the K/V of already decoded positions instead of recomputing them
+            masked_attention, cache['self'] = self.masked_multihead_attention(
+                x_1, x_1, x_1, mask=d_mask, past_kv=cache['self'], use_cache=True
+            )
+        x = x + self.drop_out_1(masked_attention) # (B, L, d_model)
         x_2 = self.layer_norm_2(x) # (B, L, d_model)
-        x = x + self.drop_out_2(
-            self.multihead_attention(x_2, e_output, e_output, mask=e_mask)
-        ) # (B, L, d_model)
+        if cache is None:
+            attention = self.multihead_attention(x_2, e_output, e_output, mask=e_mask)
+        else:
+            # The encoder output never changes, so its projected K/V is computed only once
+            attention, cache['cross'] = self.multihead_attention(
+                x_2, e_output, e_output, mask=e_mask, past_kv=cache['cross'], use_cache=True, static_kv=True
+            )
+        x = x + self.drop_out_2(attention) # (B, L, d_model)
         x_3 = self.layer_norm_3(x) # (B, L, d_model)
         x = x + self.drop_out_3(self.feed_forward(x_3)) # (B, L, d_model)
 
@@ -73,24 +83,31 @@ class MultiheadAttention(nn.Module):
         # Final output linear transformation
         self.w_0 = nn.Linear(d_model, d_model)
 
-    def forward(self, q, k, v, mask=None):
+    def forward(self, q, k, v, mask=None, past_kv=None, use_cache=False, static_kv=False):
         input_shape = q.shape
 
-        # Linear calculation +  split into num_heads
-        q = self.w_q(q).view(input_shape[0], -1, num_heads, d_k) # (B, L, num_heads, d_k)
-        k = self.w_k(k).view(input_shape[0], -1, num_heads, d_k) # (B, L, num_heads, d_k)
-        v = self.w_v(v).view(input_shape[0], -1, num_heads, d_k) # (B, L, num_heads, d_k)
+        # Linear calculation +  split into num_heads, in size (B, num_heads, L, d_k)
+        q = self.w_q(q).view(input_shape[0], -1, num_heads, d_k).transpose(1, 2) # (B, num_heads, L, d_k)
 
-        # For convenience, convert all tensors in size (B, num_heads, L, d_k)
-        q = q.transpose(1, 2)
-        k = k.transpose(1, 2)
-        v = v.transpose(1, 2)
+        if static_kv and past_kv is not None:
+            # The K/V source is fixed (e.g. encoder output), so reuse its cached projection
+            k, v = past_kv
+        else:
+            k = self.w_k(k).view(input_shape[0], -1, num_heads, d_k).transpose(1, 2) # (B, num_heads, L, d_k)
+            v = self.w_v(v).view(input_shape[0], -1, num_heads, d_k).transpose(1, 2) # (B, num_heads, L, d_k)
+            if past_kv is not None:
+                # Prepend the cached K/V of the previously decoded positions
+                k = torch.cat([past_kv[0], k], dim=2) # (B, num_heads, L_past+L, d_k)
+                v = torch.cat([past_kv[1], v], dim=2) # (B, num_heads, L_past+L, d_k)
 
         # Conduct self-attention
         attn_values = self.self_attention(q, k, v, mask=mask) # (B, num_heads, L, d_k)
         concat_output = attn_values.transpose(1, 2)\
             .contiguous().view(input_shape[0], -1, d_model) # (B, L, d_model)
 
+        if use_cache:
+            return self.w_0(concat_output), (k, v)
+
         return self.w_0(concat_output)
 
     def self_attention(self, q, k, v, mask=None):
@@ -157,8 +174,8 @@ class PositionalEncoder(nn.Module):
         pe_matrix = pe_matrix.unsqueeze(0) # (1, L, d_model)
         self.positional_encoding = pe_matrix.to(device=device).requires_grad_(False)
 
-    def forward(self, x):
+    def forward(self, x, pos=0):
         x = x * math.sqrt(d_model) # (B, L, d_model)
-        x = x + self.positional_encoding # (B, L, d_model)
+        x = x + self.positional_encoding[:, pos:pos+x.shape[1]] # (B, L, d_model)
 
         return x
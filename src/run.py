@@ -3,9 +3,9 @@ from custom_data import *
 from transformer import *
 from data_structure import *
 import torch
+import torch.distributed as dist
 import argparse
 import datetime
-import copy
 import sentencepiece as spm
 import sys
 import os
@@ -13,36 +13,41 @@ import os
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 num_gpus = torch.cuda.device_count()
 
+# torchrun sets LOCAL_RANK; without it we run in ordinary single-process mode
+local_rank = int(os.environ.get('LOCAL_RANK', -1))
+is_distributed = local_rank >= 0 and num_gpus > 1
+if is_distributed:
+    dist.init_process_group(backend='nccl')
+    torch.cuda.set_device(local_rank)
+    device = torch.device('cuda', local_rank)
+
+def init_weights(module):
+    if isinstance(module, nn.Linear):
+        nn.init.xavier_uniform_(module.weight)
+        if module.bias is not None:
+            nn.init.zeros_(module.bias)
+    elif isinstance(module, nn.Embedding):
+        nn.init.xavier_uniform_(module.weight)
+
+
 class Manager():
     def __init__(self, is_train=True, ckpt_name=None):
-        # Load vocabs
+        # Load vocabs in a single pass; split('\t', 1) stops at the first tab, which also drops the newline
         print("Loading vocabs...")
-        self.src_i2w = {}
-        self.trg_i2w = {}
-
         with open(f"{SP_DIR}/{src_model_prefix}.vocab") as f:
-            lines = f.readlines()
-        for i, line in enumerate(lines):
-            word = line.strip().split('\t')[0]
-            self.src_i2w[i] = word
+            self.src_i2w = {i: line.split('\t', 1)[0] for i, line in enumerate(f)}
 
         with open(f"{SP_DIR}/{trg_model_prefix}.vocab") as f:
-            lines = f.readlines()
-        for i, line in enumerate(lines):
-            word = line.strip().split('\t')[0]
-            self.trg_i2w[i] = word
+            self.trg_i2w = {i: line.split('\t', 1)[0] for i, line in enumerate(f)}
 
         print(f"The size of src vocab is {len(self.src_i2w)} and that of trg vocab is {len(self.trg_i2w)}.")
 
+        # The causal no-peak mask is a constant, so build it once instead of per batch
+        self.nopeak_mask = torch.tril(torch.ones([1, seq_len, seq_len], dtype=torch.bool, device=device))  # (1, L, L)
+
         # Load Transformer model & Adam optimizer
         print("Loading Transformer model & Adam optimizer...")
         self.model = Transformer(src_vocab_size=len(self.src_i2w), trg_vocab_size=len(self.trg_i2w)).to(device)
-        
-        # If more than one GPU is available, wrap the model with DataParallel for parallel training
-        if num_gpus > 1:
-            print(f"Multiple GPUs detected ({num_gpus}). Using DataParallel for parallelization.")
-            self.model = nn.DataParallel(self.model)
-        
         self.optim = torch.optim.Adam(self.model.parameters(), lr=learning_rate)
         self.best_loss = sys.float_info.max
 
@@ -50,28 +55,50 @@ class Manager():
             assert os.path.exists(f"{ckpt_dir}/{ckpt_name}"), f"There is no checkpoint named {ckpt_name}."
 
             print("Loading checkpoint...")
-            if(num_gpus == 0):
-                checkpoint = torch.load(f"{ckpt_dir}/{ckpt_name}", map_location='cpu', weights_only=False)
-            else:
-                checkpoint = torch.load(f"{ckpt_dir}/{ckpt_name}", weights_only=False)
+            # map_location keeps each process on its own device instead of the one the ckpt was saved from
+            checkpoint = torch.load(f"{ckpt_dir}/{ckpt_name}", map_location=device, weights_only=False)
             self.model.load_state_dict(checkpoint['model_state_dict'])
             self.optim.load_state_dict(checkpoint['optim_state_dict'])
             self.best_loss = checkpoint['loss']
         else:
             print("Initializing the model...")
-            for p in self.model.parameters():
-                if p.dim() > 1:
-                    nn.init.xavier_uniform_(p)
+            with torch.no_grad():
+                self.model.apply(init_weights)
+
+        # If launched via torchrun with multiple GPUs, wrap the model with DDP (one process per GPU).
+        # This must come after the init/load above: DDP broadcasts rank 0's parameters only once,
+        # at construction, so weights set afterwards would diverge across ranks
+        if is_distributed:
+            print(f"Multiple GPUs detected ({num_gpus}). Using DistributedDataParallel for parallelization.")
+            self.model = nn.parallel.DistributedDataParallel(self.model, device_ids=[local_rank])
+
+        # Compile the forward into fused kernels; every batch is padded to seq_len,
+        # so the compiled graph is reused without recompilation
+        if num_gpus > 0 and hasattr(torch, 'compile'):
+            print("Compiling the model with torch.compile...")
+            self.model = torch.compile(self.model)
 
         if is_train:
-            # Load loss function
+            # Mixed precision: bf16 where supported, otherwise fp16 with loss scaling
+            self.use_amp = torch.cuda.is_available()
+            self.amp_dtype = torch.bfloat16 if self.use_amp and torch.cuda.is_bf16_supported() else torch.float16
+            self.scaler = torch.amp.GradScaler(enabled=self.use_amp and self.amp_dtype == torch.float16)
+
+            # Load loss function: fused log-softmax + NLL over the raw logits, skipping pad positions
             print("Loading loss function...")
-            self.criterion = nn.NLLLoss()
+            self.criterion = nn.CrossEntropyLoss(ignore_index=pad_id, label_smoothing=0.1)
 
             # Load dataloaders
             print("Loading dataloaders...")
             self.train_loader = get_data_loader(TRAIN_NAME)
             self.valid_loader = get_data_loader(VALID_NAME)
+        else:
+            # Load the tokenizers once so repeated inference calls skip the disk load
+            print("Loading sentencepiece tokenizers...")
+            self.src_sp = spm.SentencePieceProcessor()
+            self.trg_sp = spm.SentencePieceProcessor()
+            self.src_sp.Load(f"{SP_DIR}/{src_model_prefix}.model")
+            self.trg_sp.Load(f"{SP_DIR}/{trg_model_prefix}.model")
 
         print("Setting finished.")
 
@@ -79,9 +106,14 @@ class Manager():
         print("Training starts.")
 
         for epoch in range(1, num_epochs+1):
+            if is_distributed:
+                # Reshuffle each rank's shard with a different seed every epoch
+                self.train_loader.sampler.set_epoch(epoch)
+
             self.model.train()
             
-            train_losses = []
+            train_loss_sum = torch.zeros((), device=device)
+            num_batches = 0
             start_time = datetime.datetime.now()
             
             # Determine logging interval (quarter of an epoch)
@@ -90,31 +122,44 @@ class Manager():
             
             for i, batch in tqdm(enumerate(self.train_loader), total=total_batches):
                 src_input, trg_input, trg_output = batch
-                src_input, trg_input, trg_output = src_input.to(device), trg_input.to(device), trg_output.to(device)
+                src_input = src_input.to(device, non_blocking=True)
+                trg_input = trg_input.to(device, non_blocking=True)
+                trg_output = trg_output.to(device, non_blocking=True)
 
                 e_mask, d_mask = self.make_mask(src_input, trg_input)
 
-                output = self.model(src_input, trg_input, e_mask, d_mask)  # (B, L, vocab_size)
+                with torch.autocast(device_type=device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                    output = self.model(src_input, trg_input, e_mask, d_mask)  # (B, L, vocab_size)
+
+                    trg_output_shape = trg_output.shape
+                    loss = self.criterion(
+                        output.view(-1, sp_vocab_size),
+                        trg_output.view(trg_output_shape[0] * trg_output_shape[1])
+                    )
+
+                # Accumulate gradients over accum_steps micro-batches before stepping;
+                # the loss is scaled so the summed gradient matches one large batch
+                is_update_step = (i+1) % accum_steps == 0 or (i+1) == total_batches
+                if is_distributed and not is_update_step:
+                    # Defer the gradient all-reduce to the update step
+                    with self.model.no_sync():
+                        self.scaler.scale(loss / accum_steps).backward()
+                else:
+                    self.scaler.scale(loss / accum_steps).backward()
 
-                trg_output_shape = trg_output.shape
-                self.optim.zero_grad()
-                loss = self.criterion(
-                    output.view(-1, sp_vocab_size),
-                    trg_output.view(trg_output_shape[0] * trg_output_shape[1])
-                )
+                if is_update_step:
+                    self.scaler.step(self.optim)
+                    self.scaler.update()
+                    self.optim.zero_grad(set_to_none=True)
 
-                loss.backward()
-                self.optim.step()
+                # Accumulate on device; calling .item() here would sync the GPU every step
+                train_loss_sum += loss.detach()
+                num_batches += 1
 
-                train_losses.append(loss.item())
-                
-                del src_input, trg_input, trg_output, e_mask, d_mask, output
-                torch.cuda.empty_cache()
-                
                 # Log metrics every quarter of the epoch
                 if (i+1) % quarter_epoch_interval == 0 or (i+1) == total_batches:
                     elapsed = datetime.datetime.now() - start_time
-                    avg_loss_so_far = np.mean(train_losses)
+                    avg_loss_so_far = (train_loss_sum / num_batches).item()
                     progress_pct = ((i+1) / total_batches) * 100
                     print(f"Epoch {epoch}: {progress_pct:.0f}% done - Avg Loss so far: {avg_loss_so_far:.4f}, Elapsed Time: {elapsed}")
 
@@ -125,24 +170,34 @@ class Manager():
             minutes = (seconds % 3600) // 60
             seconds = seconds % 60
 
-            mean_train_loss = np.mean(train_losses)
+            mean_train_loss = (train_loss_sum / num_batches).item()
             print(f"#################### Epoch: {epoch} ####################")
             print(f"Train loss: {mean_train_loss} || One epoch training time: {hours}hrs {minutes}mins {seconds}secs")
 
             valid_loss, valid_time = self.validation()
             
             if valid_loss < self.best_loss:
-                if not os.path.exists(ckpt_dir):
-                    os.mkdir(ckpt_dir)
-                    
                 self.best_loss = valid_loss
-                state_dict = {
-                    'model_state_dict': self.model.state_dict(),
-                    'optim_state_dict': self.optim.state_dict(),
-                    'loss': self.best_loss
-                }
-                torch.save(state_dict, f"{ckpt_dir}/best_ckpt.tar")
-                print(f"***** Current best checkpoint is saved. *****")
+
+                # Only rank 0 writes the checkpoint to avoid clobbering from other processes
+                if not is_distributed or dist.get_rank() == 0:
+                    if not os.path.exists(ckpt_dir):
+                        os.mkdir(ckpt_dir)
+
+                    # Unwrap torch.compile and DDP so the saved keys load into a bare model
+                    model_to_save = getattr(self.model, '_orig_mod', self.model)
+                    model_to_save = getattr(model_to_save, 'module', model_to_save)
+                    state_dict = {
+                        'model_state_dict': model_to_save.state_dict(),
+                        'optim_state_dict': self.optim.state_dict(),
+                        'loss': self.best_loss
+                    }
+
+                    # Write to a staging path first so a crash mid-save never corrupts the best checkpoint
+                    tmp_path = f"{ckpt_dir}/best_ckpt.tar.tmp"
+                    torch.save(state_dict, tmp_path)
+                    os.replace(tmp_path, f"{ckpt_dir}/best_ckpt.tar")
+                    print(f"***** Current best checkpoint is saved. *****")
 
             print(f"Best valid loss: {self.best_loss}")
             print(f"Valid loss: {valid_loss} || One epoch training time: {valid_time}")
@@ -153,28 +208,30 @@ class Manager():
         print("Validation processing...")
         self.model.eval()
         
-        valid_losses = []
+        valid_loss_sum = torch.zeros((), device=device)
+        num_batches = 0
         start_time = datetime.datetime.now()
 
-        with torch.no_grad():
+        with torch.inference_mode():
             for i, batch in tqdm(enumerate(self.valid_loader)):
                 src_input, trg_input, trg_output = batch
-                src_input, trg_input, trg_output = src_input.to(device), trg_input.to(device), trg_output.to(device)
+                src_input = src_input.to(device, non_blocking=True)
+                trg_input = trg_input.to(device, non_blocking=True)
+                trg_output = trg_output.to(device, non_blocking=True)
 
                 e_mask, d_mask = self.make_mask(src_input, trg_input)
 
-                output = self.model(src_input, trg_input, e_mask, d_mask)  # (B, L, vocab_size)
+                with torch.autocast(device_type=device.type, dtype=self.amp_dtype, enabled=self.use_amp):
+                    output = self.model(src_input, trg_input, e_mask, d_mask)  # (B, L, vocab_size)
 
-                trg_output_shape = trg_output.shape
-                loss = self.criterion(
-                    output.view(-1, sp_vocab_size),
-                    trg_output.view(trg_output_shape[0] * trg_output_shape[1])
-                )
+                    trg_output_shape = trg_output.shape
+                    loss = self.criterion(
+                        output.view(-1, sp_vocab_size),
+                        trg_output.view(trg_output_shape[0] * trg_output_shape[1])
+                    )
 
-                valid_losses.append(loss.item())
-
-                del src_input, trg_input, trg_output, e_mask, d_mask, output
-                torch.cuda.empty_cache()
+                valid_loss_sum += loss.detach()
+                num_batches += 1
 
         end_time = datetime.datetime.now()
         validation_time = end_time - start_time
@@ -183,7 +240,7 @@ class Manager():
         minutes = (seconds % 3600) // 60
         seconds = seconds % 60
         
-        mean_valid_loss = np.mean(valid_losses)
+        mean_valid_loss = (valid_loss_sum / num_batches).item()
         
         return mean_valid_loss, f"{hours}hrs {minutes}mins {seconds}secs"
 
@@ -191,30 +248,26 @@ class Manager():
         print("Inference starts.")
         self.model.eval()
 
-        print("Loading sentencepiece tokenizer...")
-        src_sp = spm.SentencePieceProcessor()
-        trg_sp = spm.SentencePieceProcessor()
-        src_sp.Load(f"{SP_DIR}/{src_model_prefix}.model")
-        trg_sp.Load(f"{SP_DIR}/{trg_model_prefix}.model")
-
         print("Preprocessing input sentence...")
-        tokenized = src_sp.EncodeAsIds(input_sentence)
+        tokenized = self.src_sp.EncodeAsIds(input_sentence)
         src_data = torch.LongTensor(pad_or_truncate(tokenized)).unsqueeze(0).to(device)  # (1, L)
         e_mask = (src_data != pad_id).unsqueeze(1).to(device)  # (1, 1, L)
 
         start_time = datetime.datetime.now()
 
-        print("Encoding input sentence...")
-        src_data = self.model.src_embedding(src_data)
-        src_data = self.model.positional_encoder(src_data)
-        e_output = self.model.encoder(src_data, e_mask)  # (1, L, d_model)
+        # inference_mode is cheaper than no_grad: no version counters or view tracking
+        with torch.inference_mode():
+            print("Encoding input sentence...")
+            src_data = self.model.src_embedding(src_data)
+            src_data = self.model.positional_encoder(src_data)
+            e_output = self.model.encoder(src_data, e_mask)  # (1, L, d_model)
 
-        if method == 'greedy':
-            print("Greedy decoding selected.")
-            result = self.greedy_search(e_output, e_mask, trg_sp)
-        elif method == 'beam':
-            print("Beam search selected.")
-            result = self.beam_search(e_output, e_mask, trg_sp)
+            if method == 'greedy':
+                print("Greedy decoding selected.")
+                result = self.greedy_search(e_output, e_mask, self.trg_sp)
+            elif method == 'beam':
+                print("Beam search selected.")
+                result = self.beam_search(e_output, e_mask, self.trg_sp)
 
         end_time = datetime.datetime.now()
 
@@ -227,115 +280,125 @@ class Manager():
         print(f"Result: {result}")
         print(f"Inference finished! || Total inference time: {minutes}mins {seconds}secs")
         
+    @torch.inference_mode()
     def greedy_search(self, e_output, e_mask, trg_sp):
-        last_words = torch.LongTensor([pad_id] * seq_len).to(device)  # (L)
-        last_words[0] = sos_id  # (L)
-        cur_len = 1
-
-        for i in range(seq_len):
-            d_mask = (last_words.unsqueeze(0) != pad_id).unsqueeze(1).to(device)  # (1, 1, L)
-            nopeak_mask = torch.ones([1, seq_len, seq_len], dtype=torch.bool).to(device)  # (1, L, L)
-            nopeak_mask = torch.tril(nopeak_mask)  # (1, L, L) triangular shape
-            d_mask = d_mask & nopeak_mask  # (1, L, L)
-
-            trg_embedded = self.model.trg_embedding(last_words.unsqueeze(0))
-            trg_positional_encoded = self.model.positional_encoder(trg_embedded)
+        eos_check_interval = 8
+        cache = self.model.decoder.init_cache()
+        generated = torch.full((seq_len,), pad_id, dtype=torch.long, device=device)  # (L)
+        generated[0] = sos_id
+        last_word = generated[:1]  # (1)
+        num_generated = 0
+
+        for i in range(seq_len-1):
+            trg_embedded = self.model.trg_embedding(last_word.unsqueeze(0))  # (1, 1, d_model)
+            trg_positional_encoded = self.model.positional_encoder(trg_embedded, pos=i)
             decoder_output = self.model.decoder(
                 trg_positional_encoded,
                 e_output,
                 e_mask,
-                d_mask
-            )  # (1, L, d_model)
+                None,  # causal masking is implicit when decoding one position at a time
+                cache=cache
+            )  # (1, 1, d_model)
 
-            output = self.model.softmax(
-                self.model.output_linear(decoder_output)
-            )  # (1, L, trg_vocab_size)
+            # argmax over raw logits picks the same token as over (log-)softmax
+            output = self.model.output_linear(decoder_output)  # (1, 1, trg_vocab_size)
 
-            output = torch.argmax(output, dim=-1)  # (1, L)
-            last_word_id = output[0][i].item()
-            
-            if i < seq_len-1:
-                last_words[i+1] = last_word_id
-                cur_len += 1
-            
-            if last_word_id == eos_id:
+            # Keep the chosen token on device; feeding it back needs no host round-trip
+            last_word = torch.argmax(output, dim=-1)[0]  # (1)
+            generated[i+1] = last_word[0]
+            num_generated = i + 1
+
+            # An .item() per token would sync the GPU every step, so poll for eos periodically
+            if (i+1) % eos_check_interval == 0 and (generated[1:i+2] == eos_id).any().item():
                 break
 
-        if last_words[-1].item() == pad_id:
-            decoded_output = last_words[1:cur_len].tolist()
-        else:
-            decoded_output = last_words[1:].tolist()
+        decoded_output = generated[1:num_generated+1].tolist()
+        if eos_id in decoded_output:
+            decoded_output = decoded_output[:decoded_output.index(eos_id)]
         decoded_output = trg_sp.decode_ids(decoded_output)
-        
+
         return decoded_output
-    
+
+    @torch.inference_mode()
     def beam_search(self, e_output, e_mask, trg_sp):
-        cur_queue = PriorityQueue()
-        for k in range(beam_size):
-            cur_queue.put(BeamNode(sos_id, -0.0, [sos_id]))
-        
-        finished_count = 0
-        
-        for pos in range(seq_len):
-            new_queue = PriorityQueue()
-            for k in range(beam_size):
-                node = cur_queue.get()
-                if node.is_finished:
-                    new_queue.put(node)
-                else:
-                    trg_input = torch.LongTensor(node.decoded + [pad_id] * (seq_len - len(node.decoded))).to(device)  # (L)
-                    d_mask = (trg_input.unsqueeze(0) != pad_id).unsqueeze(1).to(device)  # (1, 1, L)
-                    nopeak_mask = torch.ones([1, seq_len, seq_len], dtype=torch.bool).to(device)
-                    nopeak_mask = torch.tril(nopeak_mask)  # (1, L, L)
-                    d_mask = d_mask & nopeak_mask  # (1, L, L)
-                    
-                    trg_embedded = self.model.trg_embedding(trg_input.unsqueeze(0))
-                    trg_positional_encoded = self.model.positional_encoder(trg_embedded)
-                    decoder_output = self.model.decoder(
-                        trg_positional_encoded,
-                        e_output,
-                        e_mask,
-                        d_mask
-                    )  # (1, L, d_model)
-
-                    output = self.model.softmax(
-                        self.model.output_linear(decoder_output)
-                    )  # (1, L, trg_vocab_size)
-                    
-                    output = torch.topk(output[0][pos], dim=-1, k=beam_size)
-                    last_word_ids = output.indices.tolist()  # (k)
-                    last_word_prob = output.values.tolist()  # (k)
-                    
-                    for i, idx in enumerate(last_word_ids):
-                        new_node = BeamNode(idx, -(-node.prob + last_word_prob[i]), node.decoded + [idx])
-                        if idx == eos_id:
-                            new_node.prob = new_node.prob / float(len(new_node.decoded))
-                            new_node.is_finished = True
-                            finished_count += 1
-                        new_queue.put(new_node)
-            
-            cur_queue = copy.deepcopy(new_queue)
-            
-            if finished_count == beam_size:
+        # Keep all k candidates in one batch so each position costs a single decoder forward.
+        # expand is a zero-copy broadcast view; the attention matmuls handle the stride-0 batch
+        e_output = e_output.expand(beam_size, -1, -1)  # (k, L, d_model)
+        e_mask = e_mask.expand(beam_size, -1, -1)  # (k, 1, L)
+
+        cache = self.model.decoder.init_cache()
+        log_probs = torch.zeros(beam_size, device=device)  # (k)
+        finished = torch.zeros(beam_size, dtype=torch.bool, device=device)  # (k)
+        beam_tokens = torch.full((beam_size, seq_len), pad_id, dtype=torch.long, device=device)  # (k, L)
+        beam_tokens[:, 0] = sos_id
+        beam_lens = torch.ones(beam_size, dtype=torch.long, device=device)  # (k), sos included
+        last_words = beam_tokens[:, 0]  # (k)
+
+        for pos in range(seq_len-1):
+            trg_embedded = self.model.trg_embedding(last_words.unsqueeze(1))  # (k, 1, d_model)
+            trg_positional_encoded = self.model.positional_encoder(trg_embedded, pos=pos)
+            decoder_output = self.model.decoder(
+                trg_positional_encoded,
+                e_output,
+                e_mask,
+                None,  # causal masking is implicit when decoding one position at a time
+                cache=cache
+            )  # (k, 1, d_model)
+
+            # Beam scores accumulate across steps, so they need normalized log-probs
+            output = self.model.softmax(
+                self.model.output_linear(decoder_output[:, -1])
+            )  # (k, trg_vocab_size)
+
+            vocab_size = output.shape[-1]
+            scores = log_probs.unsqueeze(1) + output  # (k, trg_vocab_size)
+
+            # Carry finished beams through with their score unchanged (pad column only)
+            scores[finished] = float('-inf')
+            scores[finished, pad_id] = log_probs[finished]
+            if pos == 0:
+                # All beams start identical, so expand only the first to get k distinct candidates
+                scores[1:] = float('-inf')
+
+            # The best k among all k * vocab_size continuations
+            top_scores, top_indices = torch.topk(scores.view(-1), k=beam_size)  # (k)
+            parent_ids = top_indices // vocab_size  # (k)
+            token_ids = top_indices % vocab_size  # (k)
+
+            # Each surviving beam must continue from its parent's state
+            self.model.decoder.reorder_cache(cache, parent_ids)
+            log_probs = top_scores
+            finished = finished[parent_ids]
+            beam_tokens = beam_tokens[parent_ids]
+            beam_lens = beam_lens[parent_ids]
+
+            # Append the new tokens in place (finished parents got pad, a no-op on the buffer)
+            active = ~finished
+            beam_tokens[:, pos+1] = token_ids
+            beam_lens = beam_lens + active.long()
+
+            # Length-normalize the score once a hypothesis is complete
+            newly_finished = active & (token_ids == eos_id)
+            log_probs = torch.where(newly_finished, log_probs / beam_lens.float(), log_probs)
+            finished = finished | newly_finished
+            last_words = token_ids
+
+            if finished.all():
                 break
-        
-        decoded_output = cur_queue.get().decoded
-        
-        if decoded_output[-1] == eos_id:
-            decoded_output = decoded_output[1:-1]
-        else:
-            decoded_output = decoded_output[1:]
-            
+
+        best = torch.argmax(log_probs).item()
+        decoded_output = beam_tokens[best, 1:beam_lens[best].item()].tolist()  # sos stripped
+
+        if len(decoded_output) > 0 and decoded_output[-1] == eos_id:
+            decoded_output = decoded_output[:-1]
+
         return trg_sp.decode_ids(decoded_output)
-        
+
 
     def make_mask(self, src_input, trg_input):
         e_mask = (src_input != pad_id).unsqueeze(1)  # (B, 1, L)
         d_mask = (trg_input != pad_id).unsqueeze(1)  # (B, 1, L)
-
-        nopeak_mask = torch.ones([1, seq_len, seq_len], dtype=torch.bool)  # (1, L, L)
-        nopeak_mask = torch.tril(nopeak_mask).to(device)  # (1, L, L)
-        d_mask = d_mask & nopeak_mask  # (B, L, L)
+        d_mask = d_mask & self.nopeak_mask  # (B, L, L)
 
         return e_mask, d_mask
 
@@ -454,7 +517,8 @@ def beam_search(self, e_output, e_mask, trg_sp):
                         finished_count += 1
                     new_queue.put(new_node)
         
-        cur_queue = copy.deepcopy(new_queue)
+        # new_queue is rebuilt from scratch next iteration, so a reference is enough
+        cur_queue = new_queue
         
         if finished_count == beam_size:
             break
@@ -17,7 +17,7 @@ class Transformer(nn.Module):
         self.encoder = Encoder()
         self.decoder = Decoder()
         self.output_linear = nn.Linear(d_model, self.trg_vocab_size)
-        self.softmax = nn.LogSoftmax(dim=-1)
+        self.softmax = nn.LogSoftmax(dim=-1)  # only used for scoring during beam search
 
     def forward(self, src_input, trg_input, e_mask=None, d_mask=None):
         src_input = self.src_embedding(src_input) # (B, L) => (B, L, d_model)
@@ -28,7 +28,7 @@ class Transformer(nn.Module):
         e_output = self.encoder(src_input, e_mask) # (B, L, d_model)
         d_output = self.decoder(trg_input, e_output, e_mask, d_mask) # (B, L, d_model)
 
-        output = self.softmax(self.output_linear(d_output)) # (B, L, d_model) => # (B, L, trg_vocab_size)
+        output = self.output_linear(d_output) # (B, L, d_model) => # (B, L, trg_vocab_size), raw logits
 
         return output
 
@@ -52,8 +52,21 @@ class Decoder(nn.Module):
         self.layers = nn.ModuleList([DecoderLayer() for i in range(num_layers)])
         self.layer_norm = LayerNormalization()
 
-    def forward(self, x, e_output, e_mask, d_mask):
+    def forward(self, x, e_output, e_mask, d_mask, cache=None):
         for i in range(num_layers):
-            x = self.layers[i](x, e_output, e_mask, d_mask)
+            if cache is not None:
+                x = self.layers[i](x, e_output, e_mask, d_mask, cache=cache[i])
+            else:
+                x = self.layers[i](x, e_output, e_mask, d_mask)
 
         return self.layer_norm(x)
+
+    def init_cache(self):
+        # One slot per layer: K/V of the decoded positions so far + projected encoder K/V
+        return [{'self': None, 'cross': None} for i in range(num_layers)]
+
+    def reorder_cache(self, cache, beam_ids):
+        # After beam pruning, each surviving beam continues from its parent's K/V
+        for layer_cache in cache:
+            k, v = layer_cache['self']
+            layer_cache['self'] = (k.index_select(0, beam_ids), v.index_select(0, beam_ids))